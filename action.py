@@ -15,13 +15,24 @@
 """Carry out voice commands by recognising keywords."""
 
 import datetime
-from datetime import timedelta
 import logging
+import re
+import socket
 import subprocess
 import actionbase
 import time
+
+from core import TS_FMT as _TS_FMT
 from mode import Mode
 
+try:
+    import alsaaudio
+except ImportError:
+    # Fall back to running amixer in VolumeControl.
+    alsaaudio = None
+
+_NOW = datetime.datetime.now
+
 # =============================================================================
 #
 # Hey, Makers!
@@ -74,6 +85,34 @@ class SpeakAction(object):
         self.say(self.words)
 
 
+# Example: Say a fixed response quickly
+# =====================================
+#
+# This works just like SpeakAction, but asks the TTS engine for the words once,
+# when the voice commands are configured. Saying them plays the saved audio,
+# which is much quicker than synthesizing the words again.
+
+def _prepare(say, *phrases):
+    """Have say synthesize phrases ahead of time, if it can.
+
+    Only a say function from tts.create_say has a prepare method; any other
+    say function just synthesizes the words when they are said.
+    """
+    prepare = getattr(say, 'prepare', None)
+    if prepare is not None:
+        for words in phrases:
+            prepare(words)
+
+
+class CachedSpeakAction(SpeakAction):
+
+    """Says the given text via TTS, synthesizing it only once."""
+
+    def __init__(self, say, words):
+        super().__init__(say, words)
+        _prepare(say, words)
+
+
 # Example: Tell the current time
 # ==============================
 #
@@ -81,6 +120,11 @@ class SpeakAction(object):
 # into helpful text (for example, "It is twenty past four."). The run function
 # uses to_str say it aloud.
 
+_HRS_TEXT = ('midnight', 'one', 'two', 'three', 'four', 'five', 'six',
+             'seven', 'eight', 'nine', 'ten', 'eleven', 'twelve')
+_MINS_TEXT = ("five", "ten", "quarter", "twenty", "twenty-five", "half")
+
+
 class SpeakTime(object):
 
     """Says the current local time with TTS."""
@@ -89,14 +133,11 @@ class SpeakTime(object):
         self.say = say
 
     def run(self, voice_command):
-        time_str = self.to_str(datetime.datetime.now())
+        time_str = self.to_str(_NOW())
         self.say(time_str)
 
     def to_str(self, dt):
         """Convert a datetime to a human-readable string."""
-        HRS_TEXT = ['midnight', 'one', 'two', 'three', 'four', 'five', 'six',
-                    'seven', 'eight', 'nine', 'ten', 'eleven', 'twelve']
-        MINS_TEXT = ["five", "ten", "quarter", "twenty", "twenty-five", "half"]
         hour = dt.hour
         minute = dt.minute
 
@@ -114,65 +155,117 @@ class SpeakTime(object):
         if minute_rounded == 0:
             if hour == 0:
                 return 'It is midnight.'
-            return "It is %s o'clock." % HRS_TEXT[hour]
+            return "It is %s o'clock." % _HRS_TEXT[hour]
 
         if minute_is_inverted:
-            return 'It is %s to %s.' % (MINS_TEXT[minute_rounded - 1], HRS_TEXT[hour])
-        return 'It is %s past %s.' % (MINS_TEXT[minute_rounded - 1], HRS_TEXT[hour])
+            return 'It is %s to %s.' % (_MINS_TEXT[minute_rounded - 1], _HRS_TEXT[hour])
+        return 'It is %s past %s.' % (_MINS_TEXT[minute_rounded - 1], _HRS_TEXT[hour])
 
 
 # Example: Run a shell command and say its output
 # ===============================================
 #
-# This example will use a shell command to work out what to say. You choose the
-# shell command when you add the voice command below - look for the example
-# below where it says the IP address of the Raspberry Pi.
+# This example will use a command to work out what to say. You choose the
+# command when you add the voice command below. The command is given as a list
+# of arguments (for example ['hostname']) and is run directly, without
+# starting a shell.
 
 class SpeakShellCommandOutput(object):
 
-    """Speaks out the output of a shell command."""
+    """Speaks out the output of a command, run directly (not via a shell)."""
 
-    def __init__(self, say, shell_command, failure_text):
+    def __init__(self, say, argv, failure_text):
         self.say = say
-        self.shell_command = shell_command
+        self.argv = argv
         self.failure_text = failure_text
 
     def run(self, voice_command):
-        output = subprocess.check_output(self.shell_command, shell=True).strip()
+        output = subprocess.run(self.argv, capture_output=True,
+                                check=True).stdout.strip()
         if output:
             self.say(output)
         elif self.failure_text:
             self.say(self.failure_text)
 
 
+# Example: Say the IP address
+# ===========================
+#
+# This example asks the network stack which local address it would use to reach
+# the internet. Connecting a UDP socket doesn't send any packets, so this works
+# without a shell command and without any network traffic.
+
+class SpeakIpAddress(object):
+
+    """Speaks out the IP address of the Raspberry Pi."""
+
+    def __init__(self, say, failure_text):
+        self.say = say
+        self.failure_text = failure_text
+
+    def run(self, voice_command):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect(('1.1.1.1', 1))
+                self.say(sock.getsockname()[0])
+        except OSError:
+            logging.exception("Error finding the IP address.")
+            self.say(self.failure_text)
+
+
 # Example: Change the volume
 # ==========================
 #
 # This example will can change the speaker volume of the Raspberry Pi. It uses
-# the shell command SET_VOLUME to change the volume, and then GET_VOLUME gets
-# the new volume. The example says the new volume aloud after changing the
-# volume.
+# the ALSA mixer to read the current volume, changes it and then sets the new
+# volume. The example says the new volume aloud after changing the volume.
+# If the alsaaudio module isn't installed, it runs amixer instead.
+
+# Finds the volume in the output of "amixer get Master".
+_VOL_RE = re.compile(rb'Front Left:.*\[(\d+)%\]')
+
 
 class VolumeControl(object):
 
     """Changes the volume and says the new level."""
 
-    GET_VOLUME = r'amixer get Master | grep "Front Left:" | sed "s/.*\[\([0-9]\+\)%\].*/\1/"'
-    SET_VOLUME = 'amixer -q set Master %d%%'
+    MIXER = 'Master'
 
     def __init__(self, say, change):
         self.say = say
         self.change = change
 
     def run(self, voice_command):
-        res = subprocess.check_output(VolumeControl.GET_VOLUME, shell=True).strip()
+        if alsaaudio:
+            self._run_alsaaudio()
+        else:
+            self._run_amixer()
+
+    def _run_alsaaudio(self):
+        try:
+            mixer = alsaaudio.Mixer(VolumeControl.MIXER)
+            res = mixer.getvolume()[0]
+            logging.info("volume: %s", res)
+            vol = max(0, min(100, res + self.change))
+            mixer.setvolume(vol)
+            self.say(_('Volume at %d %%.') % vol)
+        except alsaaudio.ALSAAudioError:
+            logging.exception("Error using the ALSA mixer to adjust volume.")
+
+    def _run_amixer(self):
         try:
+            out = subprocess.run(['amixer', 'get', VolumeControl.MIXER],
+                                 capture_output=True, check=True).stdout
+            match = _VOL_RE.search(out)
+            if match is None:
+                raise ValueError("No volume in amixer output: %r" % out)
+            res = int(match.group(1))
             logging.info("volume: %s", res)
-            vol = int(res) + self.change
-            vol = max(0, min(100, vol))
-            subprocess.call(VolumeControl.SET_VOLUME % vol, shell=True)
+            vol = max(0, min(100, res + self.change))
+            subprocess.run(['amixer', '-q', 'set', VolumeControl.MIXER,
+                            '%d%%' % vol], check=True)
             self.say(_('Volume at %d %%.') % vol)
-        except (ValueError, subprocess.CalledProcessError):
+        except (OSError, ValueError, subprocess.CalledProcessError):
             logging.exception("Error using amixer to adjust volume.")
 
 
@@ -213,17 +306,30 @@ class PowerCommand(object):
     def __init__(self, say, command):
         self.say = say
         self.command = command
+        # Pick the handler for this command once, rather than on every run.
+        if command == 'shutdown':
+            _prepare(say, "Shutting down, goodbye")
+            self._exec = self._do_shutdown
+        elif command == 'reboot':
+            _prepare(say, "Rebooting")
+            self._exec = self._do_reboot
+        else:
+            self._exec = self._do_unknown
 
     def run(self, voice_command):
-        if (self.command == "shutdown"):
-            self.say("Shutting down, goodbye")
-            subprocess.call("sudo shutdown now", shell=True)
-        elif (self.command == "reboot"):
-            self.say("Rebooting")
-            subprocess.call("sudo shutdown -r now", shell=True)
-        else:
-            logging.error("Error identifying power command.")
-            self.say("Sorry I didn't identify that command")
+        self._exec(voice_command)
+
+    def _do_shutdown(self, voice_command):
+        self.say("Shutting down, goodbye")
+        subprocess.Popen(['sudo', 'shutdown', 'now'])
+
+    def _do_reboot(self, voice_command):
+        self.say("Rebooting")
+        subprocess.Popen(['sudo', 'shutdown', '-r', 'now'])
+
+    def _do_unknown(self, voice_command):
+        logging.error("Error identifying power command.")
+        self.say("Sorry I didn't identify that command")
 
 
 # Photo: Capture a photo using the onboard rpi camera board.
@@ -238,30 +344,37 @@ class PhotoCapture(object):
         self.say = say
         self.command = command
         self.camera_core = camera_core
+        if command == "photo":
+            _prepare(say, "I'm taking a photo. Say cheese", "Done.")
+            self._exec = self._do_photo
+        else:
+            self._exec = self._do_unknown
 
     def run(self, voice_command):
-        if (self.command == "photo"):
-            time_obj = datetime.datetime.now()
-            time_str = time_obj.strftime("%Y-%m-%d_%H-%M-%S")
-            path_str = '/home/pi/Documents'
-            self.say("I'm taking a photo. Say cheese")
-
-            # use pre-initialised camera to take photo (faster).
-            self.camera_core.take_photo(
-                "{}/photo_{}.jpg".format(path_str, time_str)
-            )
-
-            self.say("Done.")
-            # self.say(words="",
-            #     wav_file="/home/pi/voice-recognizer-raspi/src/camera-shutter-click-03.wav")
-        else:
-            logging.error("Error identifying photo command.")
-            self.say("Sorry I didn't identify that command")
+        self._exec(voice_command)
+
+    def _do_photo(self, voice_command):
+        time_str = _NOW().strftime(_TS_FMT)
+        path_str = '/home/pi/Documents'
+        self.say("I'm taking a photo. Say cheese")
+
+        # use pre-initialised camera to take photo (faster).
+        self.camera_core.take_photo(
+            f"{path_str}/photo_{time_str}.jpg"
+        )
+
+        self.say("Done.")
+        # self.say(words="",
+        #     wav_file="/home/pi/voice-recognizer-raspi/src/camera-shutter-click-03.wav")
+
+    def _do_unknown(self, voice_command):
+        logging.error("Error identifying photo command.")
+        self.say("Sorry I didn't identify that command")
 
 
 # Uptime: Respond with length of time the Pi has been up.
 # ================================
-# Run "uptime" on shell and speak the result.
+# Read the time since boot and speak the result.
 #
 
 class Uptime(object):
@@ -270,23 +383,26 @@ class Uptime(object):
     def __init__(self, say, command):
         self.say = say
         self.command = command
+        if command == "uptime":
+            self._exec = self._do_uptime
+        else:
+            self._exec = self._do_unknown
 
     def run(self, voice_command):
-        if (self.command == "uptime"):
-            with open('/proc/uptime', 'r') as f:
-                uptime_seconds = float(f.readline().split()[0])
-
-                dt = timedelta(seconds=uptime_seconds)
-                days = dt.days
-                hours = dt.seconds // 3600
-                minutes = (dt.seconds // 60) % 60
-
-                time_str = ("{} days, {} hours and {} minutes"
-                            ).format(days, hours, minutes)
-                self.say(time_str)
-        else:
-            logging.error("Error identifying power command.")
-            self.say("Sorry I didn't identify that command")
+        self._exec(voice_command)
+
+    def _do_uptime(self, voice_command):
+        uptime_seconds = int(time.clock_gettime(time.CLOCK_BOOTTIME))
+
+        minutes, seconds = divmod(uptime_seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+
+        self.say(f"{days} days, {hours} hours and {minutes} minutes")
+
+    def _do_unknown(self, voice_command):
+        logging.error("Error identifying power command.")
+        self.say("Sorry I didn't identify that command")
 
 
 # Pass: Give no response if triggered accidently.
@@ -307,6 +423,59 @@ class Pass(object):
 #
 # Start a new thread that will take several photos at set intervals.
 
+_TIME_UNITS = frozenset((
+    'second',
+    'seconds',
+    'minute',
+    'minutes',
+    'hour',
+    'hours',
+    'day',
+    'days',
+    'week',
+    'weeks',
+    'month',
+    'months',
+    'year',
+    'years'
+))
+
+
+def _quantity_after(word_list, index):
+    """Return the number words and time unit following word_list[index].
+
+    For example "every ten seconds" gives ('ten', 'seconds'). If no time unit
+    follows, all remaining words are returned with a unit of None.
+    """
+    for end in range(index + 1, len(word_list)):
+        if word_list[end] in _TIME_UNITS:
+            return ' '.join(word_list[index + 1:end]), word_list[end]
+    return ' '.join(word_list[index + 1:]), None
+
+
+# Fractions of a time unit, e.g. "every half second".
+_FRACTIONS = {'half': 0.5, 'quarter': 0.25}
+
+
+def _fraction(quantity):
+    """Return the fraction given by quantity, or None if it isn't one.
+
+    Handles words such as "half" or "a quarter of a", and decimals such as
+    "0.5", none of which Core.text2int understands.
+    """
+    words = [w for w in quantity.split() if w not in ('a', 'an', 'of')]
+    if len(words) != 1:
+        return None
+    if words[0] in _FRACTIONS:
+        return _FRACTIONS[words[0]]
+    if '.' in words[0]:
+        try:
+            return float(words[0])
+        except ValueError:
+            pass
+    return None
+
+
 class TimeLapse(object):
 
     """ Take several photos a set intervals. """
@@ -319,74 +488,37 @@ class TimeLapse(object):
         # The command still has the 'repeat after me' keyword, so we need to
         # remove it before saying whatever is left.
 
-        interval_str = ''
         interval = 10
         interval_unit = 'seconds'
-        length_str = ''
         length = 2
         length_unit = 'minutes'
 
-        time_units = [
-            'second',
-            'seconds',
-            'minute',
-            'minutes',
-            'hour',
-            'hours',
-            'day',
-            'days',
-            'week',
-            'weeks',
-            'month',
-            'months',
-            'year',
-            'years'
-        ]
-
         word_list = voice_command.split()
         for i, x in enumerate(word_list):
             if x == 'at' or x == 'every':
-                # append all text numbers together and find the time unit.
-                index = 1
-                while index < (len(word_list) - i):
-                    word = word_list[i + index]
-                    if word in time_units:
-                        # Store interval time unit
-                        # and stop processing interval.
-                        interval_unit = word
-                        index = len(word_list)
-                    else:
-                        if interval_str != '':
-                            interval_str = interval_str + ' '
-                        interval_str = interval_str + word
-                    index = index + 1
+                # join all text numbers together and find the time unit.
+                interval_str, unit = _quantity_after(word_list, i)
+                if unit:
+                    interval_unit = unit
+                fraction = _fraction(interval_str)
                 if interval_str == "":
                     interval = 1  # No number, e.g."Every minute"
+                elif fraction is not None:
+                    interval = fraction
                 else:
                     interval = self.camera_core.text2int(interval_str)
 
             if x == 'for':
-                # append all text numbers together and find the time unit.
-                index = 1
-                while index < (len(word_list) - i):
-                    word = word_list[i + index]
-                    if word in time_units:
-                        # Store length time unit
-                        # and stop processing length.
-                        length_unit = word
-                        index = len(word_list)
-                    else:
-                        if length_str != '':
-                            length_str = length_str + ' '
-                        length_str = length_str + word
-                    index = index + 1
+                # join all text numbers together and find the time unit.
+                length_str, unit = _quantity_after(word_list, i)
+                if unit:
+                    length_unit = unit
                 length = self.camera_core.text2int(length_str)
 
         # Convert interval and length into seconds.
-        interval_seconds = interval * self.camera_core.seconds_in_units(
-            interval_unit)
-        length_seconds = length * self.camera_core.seconds_in_units(
-            length_unit)
+        seconds_in_units = self.camera_core.seconds_in_units
+        interval_seconds = interval * seconds_in_units(interval_unit)
+        length_seconds = length * seconds_in_units(length_unit)
 
         # DEBUG
         # self.say("{} seconds in interval and {}"
@@ -396,8 +528,7 @@ class TimeLapse(object):
         if interval_seconds > 0 and length_seconds > 0:
             self.say(
                 "Confirmed, I'll take a photo every "
-                "{} {} for {} {}.".format(
-                    interval, interval_unit, length, length_unit))
+                f"{interval} {interval_unit} for {length} {length_unit}.")
 
             # Take the photos using threaded core module
             self.camera_core.length_seconds = length_seconds
@@ -422,16 +553,15 @@ def make_actor(say, camera):
     actor = actionbase.Actor()
 
     actor.add_keyword(
-        _('ip address'), SpeakShellCommandOutput(
-            say, "ip -4 route get 1 | head -1 | cut -d' ' -f8",
-            _('I do not have an ip address assigned to me.')))
+        _('ip address'), SpeakIpAddress(
+            say, _('I do not have an ip address assigned to me.')))
 
     actor.add_keyword(_('volume up'), VolumeControl(say, 10))
     actor.add_keyword(_('volume down'), VolumeControl(say, -10))
     actor.add_keyword(_('max volume'), VolumeControl(say, 100))
 
-    actor.add_keyword(_('repeat after me'),
-                      RepeatAfterMe(say, _('repeat after me')))
+    repeat_keyword = _('repeat after me')
+    actor.add_keyword(repeat_keyword, RepeatAfterMe(say, repeat_keyword))
 
     # =========================================
     # Makers! Add your own voice commands here.
@@ -454,7 +584,7 @@ def make_actor(say, camera):
 def add_commands_just_for_cloud_speech_api(actor, say):
     """Add simple commands that are only used with the Cloud Speech API."""
     def simple_command(keyword, response):
-        actor.add_keyword(keyword, SpeakAction(say, response))
+        actor.add_keyword(keyword, CachedSpeakAction(say, response))
 
     simple_command('alexa', _("We've been friends since we were both starter projects"))
     simple_command(
@@ -1,8 +1,97 @@
 from picamera import PiCamera
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import io
+import logging
 import time
 import threading
 from mode import Mode
 
+_NOW = datetime.datetime.now
+# Timestamp used in photo file names (action.PhotoCapture uses it too).
+TS_FMT = "%Y-%m-%d_%H-%M-%S"
+
+# Number of seconds in each spoken time unit.
+_UNIT_SECONDS = {
+    'second': 1,
+    'seconds': 1,
+    'minute': 60,
+    'minutes': 60,
+    'hour': 3600,
+    'hours': 3600,
+    'day': 86400,
+    'days': 86400,
+    'week': 604800,
+    'weeks': 604800,
+    'month': 2628000,
+    'months': 2628000,
+    'year': 31536000,
+    'years': 31536000
+}
+
+
+def _build_numwords():
+    """ Prepare "NumWords" dictionary used by Core.text2int. """
+    units = [
+        "zero",
+        "one",
+        "two",
+        "three",
+        "four",
+        "five",
+        "six",
+        "seven",
+        "eight",
+        "nine",
+        "ten",
+        "eleven",
+        "twelve",
+        "thirteen",
+        "fourteen",
+        "fifteen",
+        "sixteen",
+        "seventeen",
+        "eighteen",
+        "nineteen"
+    ]
+    tens = [
+        "",
+        "",
+        "twenty",
+        "thirty",
+        "forty",
+        "fifty",
+        "sixty",
+        "seventy",
+        "eighty",
+        "ninety"
+    ]
+    scales = [
+        "hundred",
+        "thousand",
+        "million",
+        "billion",
+        "trillion"
+    ]
+
+    numwords = {}
+    # Special words
+    numwords["and"] = (1, 0)
+    numwords["a"] = (1, 1)  # AKA 1
+    numwords["an"] = (1, 1)  # AKA 1
+    # enumerate lists above into new dictionary.
+    for idx, word in enumerate(units):
+        numwords[word] = (1, idx)
+    for idx, word in enumerate(tens):
+        numwords[word] = (1, idx * 10)
+    for idx, word in enumerate(scales):
+        numwords[word] = (10 ** (idx * 3 or 2), 0)
+    return numwords
+
+
+# Map of number words to (scale, increment), built once at import.
+_NUMWORDS = _build_numwords()
+
 
 class Core():
     """ Give no response if triggered accidently """
@@ -18,123 +107,44 @@ class Core():
 
         self.running = False
         self.main_thread = None
+        self.stop_event = threading.Event()
         self.path_str = '/home/pi/Documents'
+        # Writes captured images to disk while the camera carries on.
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        # Number of images the writer failed to save this time lapse.
+        self.failed_writes = 0
 
     def initialise_camera(self):
         """ Initialise camera module. """
         self.camera = PiCamera()
-        # Default to HIGH resolution
+        # Stay at HIGH resolution. Changing resolution restarts the
+        # sensor, so low resolution images are resized from the video
+        # port instead (see camera_lowres).
         self.camera.resolution = (self.camera_hires[0], self.camera_hires[1])
         self.camera.start_preview()
 
         # Camera warm-up time
         time.sleep(2)
 
-    def set_high_res(self):
-        """ Set camera into High Resolution mode. """
-        self.camera.resolution = (self.camera_hires[0], self.camera_hires[1])
-
-    def set_low_res(self):
-        """ Set camera into Low Resolution mode. """
-        self.camera.resolution = (self.camera_lowres[0], self.camera_lowres[1])
-
     def seconds_in_units(self, unit):
         # Convert interval and units into interval in seconds.
-        multiplyer = 1
-        if unit == 'second' or unit == 'seconds':
-            multiplyer = 1
-        elif unit == 'minute' or unit == 'minutes':
-            multiplyer = 60
-        elif unit == 'hour' or unit == 'hours':
-            multiplyer = 3600
-        elif unit == 'day' or unit == 'days':
-            multiplyer = 86400
-        elif unit == 'week' or unit == 'weeks':
-            multiplyer = 604800
-        elif unit == 'month' or unit == 'months':
-            multiplyer = 18144000
-        elif unit == 'year' or unit == 'years':
-            multiplyer = 31536000
-        return multiplyer
-
-    def text2int(self, textnum, numwords={}):
-        # Prepare "NumWords" dictionary
-        if not numwords:
-            units = [
-                "zero",
-                "one",
-                "two",
-                "three",
-                "four",
-                "five",
-                "six",
-                "seven",
-                "eight",
-                "nine",
-                "ten",
-                "eleven",
-                "twelve",
-                "thirteen",
-                "fourteen",
-                "fifteen",
-                "sixteen",
-                "seventeen",
-                "eighteen",
-                "nineteen"
-            ]
-            tens = [
-                "",
-                "",
-                "twenty",
-                "thirty",
-                "forty",
-                "fifty",
-                "sixty",
-                "seventy",
-                "eighty",
-                "ninety"
-            ]
-            scales = [
-                "hundred",
-                "thousand",
-                "million",
-                "billion",
-                "trillion"
-            ]
-
-            # Special words
-            numwords["and"] = (1, 0)
-            numwords["a"] = (1, 1)  # AKA 1
-            numwords["an"] = (1, 1)  # AKA 1
-            # enumerate lists above into new dictionary.
-            for idx, word in enumerate(units):
-                numwords[word] = (1, idx)
-            for idx, word in enumerate(tens):
-                numwords[word] = (1, idx * 10)
-            for idx, word in enumerate(scales):
-                numwords[word] = (10 ** (idx * 3 or 2), 0)
+        return _UNIT_SECONDS.get(unit, 1)
 
+    def text2int(self, textnum):
         # Loop every word in "textnum".
         current = result = 0
         for word in textnum.split():
-            if word in numwords:
-                scale, increment = numwords[word]
+            if word in _NUMWORDS:
+                scale, increment = _NUMWORDS[word]
                 current = current * scale + increment
                 if scale > 100:
                     result += current
                     current = 0
-            else:
-                # Not a valid written number, check
-                # to see if its actually a number.
-                valid_number = True
-                numbers = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
-                for c in word:
-                    if c not in numbers:
-                        valid_number = False
-                # It was a valid number, just in text.
-                if valid_number:
-                    result += int(word)
-                    current = 0
+            elif word.isdecimal():
+                # Not a written number, but it's
+                # actually a number given as digits.
+                result += int(word)
+                current = 0
 
             # else:
             #     raise Exception("Illegal word: " + word)
@@ -143,48 +153,115 @@ class Core():
 
     def take_photo(self, filename):
         if self.camera is not None:
-            self.camera.capture(filename)
+            self.camera.capture(filename, use_video_port=False)
         else:
             self.say("Camera not initialised.")
 
+    def write_file(self, filename, data):
+        """ Write captured image data to disk, logging any failure. """
+        try:
+            with open(filename, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            # e.g. the SD card is full, carry on with the next image.
+            self.failed_writes += 1
+            logging.error("Failed to save %s: %s", filename, e)
+
+    def paced_names(self, names, interval_seconds):
+        """ Yield each file name at its capture time on the monotonic
+            clock, so capture_sequence takes one photo per interval. """
+        next_time = time.monotonic()
+        for name in names:
+            sleep_for = next_time - time.monotonic()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+            yield name
+            next_time += interval_seconds
+
     def take_timelapse(self,
                        interval_seconds,
                        length_seconds,
                        filename_prepend="img_",
                        filename_append=""):
-        if self.camera is not None:
-            for filename in self.camera.capture_continuous(
-                 self.path_str +
-                 "/" + filename_prepend +
-                 "{timestamp:%Y-%m-%d_%H-%M-%S}.jpg" +
-                 filename_append):
-
-                time.sleep(interval_seconds)
-                # Subtract interval from length.
-                length_seconds = length_seconds - interval_seconds
-                if length_seconds <= 0:
+        if self.camera is not None and interval_seconds < 1.0:
+            # Sub-second intervals: capture from the video port, which
+            # keeps the encoder running between captures and is quick
+            # enough to keep up.
+            count = max(1, round(length_seconds / interval_seconds))
+            session = _NOW().strftime(TS_FMT)
+            names = [
+                f"{self.path_str}/{filename_prepend}{session}_{i:05d}.jpg"
+                f"{filename_append}"
+                for i in range(count)]
+            try:
+                self.camera.capture_sequence(
+                    self.paced_names(names, interval_seconds),
+                    use_video_port=True, resize=self.camera_lowres)
+            except OSError as e:
+                # e.g. the SD card is full, the sequence can't carry on.
+                logging.error("Time lapse stopped: %s", e)
+                self.say("Time lapse stopped early, a photo could not"
+                         " be saved.")
+            else:
+                self.say("Time lapse is complete.")
+        elif self.camera is not None:
+            last_write = None
+            self.failed_writes = 0
+            # Schedule captures against the monotonic clock, so the time
+            # spent capturing doesn't push every later photo back.
+            start = time.monotonic()
+            deadline = start + length_seconds
+            next_time = start
+            # Only the timestamp changes between file names.
+            name_prefix = self.path_str + "/" + filename_prepend
+            name_suffix = ".jpg" + filename_append
+            # Capture into memory and hand each image to the writer
+            # thread, so the SD card write overlaps the next capture.
+            for stream in self.camera.capture_continuous(
+                    io.BytesIO(), format='jpeg'):
+                time_str = _NOW().strftime(TS_FMT)
+                filename = name_prefix + time_str + name_suffix
+                last_write = self.writer.submit(
+                    self.write_file, filename, stream.getvalue())
+                stream.seek(0)
+                stream.truncate()
+
+                next_time += interval_seconds
+                sleep_for = next_time - time.monotonic()
+                if sleep_for > 0:
+                    time.sleep(sleep_for)
+                if time.monotonic() >= deadline:
                     # Stop taking photos
                     break
-            self.say("Time lapse is complete.")
+            # Writes run in order, so the last one finishing means all have.
+            if last_write is not None:
+                last_write.result()
+            if self.failed_writes:
+                self.say(f"Time lapse is complete, but {self.failed_writes}"
+                         " photos could not be saved.")
+            else:
+                self.say("Time lapse is complete.")
         else:
             self.say("Camera not initialised.")
 
     def run_loop(self):
         """ Main method to run as it's own thread. """
         self.initialise_camera()
-        while self.running:
-            # Not doing anything, sleep for
-            # a bit to allow things to happen
-            time.sleep(0.5)
+        # Not doing anything else, keep the camera
+        # warm until stop_thread() wakes us up.
+        self.stop_event.wait()
 
     def start_thread(self):
         """ Call this method to ensure thread is started. """
         if not self.running:
             self.running = True
-            self.main_thread = threading.Thread(target=self.run_loop).start()
+            self.stop_event.clear()
+            self.main_thread = threading.Thread(target=self.run_loop)
+            self.main_thread.start()
 
     def stop_thread(self):
         """ Call this method to stop thread. """
         self.running = False
+        self.stop_event.set()
         self.main_thread.join()
         self.main_thread = None
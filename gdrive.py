@@ -1,24 +1,123 @@
 from __future__ import print_function
+import argparse
+import collections
 import httplib2
+import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import google_auth_httplib2
 from apiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 from googleapiclient.http import MediaFileUpload
 
-try:
-    import argparse
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-except ImportError:
-    flags = None
+# Drive's own batch endpoint, the global /batch endpoint has been retired.
+DRIVE_BATCH_URI = 'https://www.googleapis.com/batch/drive/v3'
+
+# Most folder ids GDrive remembers at once.
+PATH_CACHE_SIZE = 1024
+
+# Files this size or larger are uploaded in resumable chunks of this size
+# (which must be a multiple of 256 KiB).
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# HTTP statuses worth retrying: rate limiting and transient server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Reasons Drive gives when it reports rate limiting as a 403.
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def _parse_flags():
+    """ Parse the authorization flags (the same ones as the old oauth2client
+        tools.argparser), ignoring any arguments meant for someone else. """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--noauth_local_webserver', action='store_true',
+                        help="Print the authorization URL instead of "
+                        "opening a browser")
+    parser.add_argument('--auth_host_port', default=8080, type=int,
+                        help='Port to listen on for the authorization reply')
+    return parser.parse_known_args()[0]
+
+
+def _is_retryable(error):
+    """ Return whether an HttpError is transient and worth retrying. """
+    status = error.resp.status
+    if status in RETRY_STATUSES:
+        return True
+    if status == 403:
+        try:
+            content = json.loads(error.content.decode('utf-8'))
+            reasons = [e.get('reason') for e in content['error']['errors']]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return any(reason in RATE_LIMIT_REASONS for reason in reasons)
+    return False
+
+
+def _call_with_retry(call, max_retries=5, base=1.0, cap=30.0):
+    """ Return call(), retrying transient Drive errors with exponential
+        backoff and jitter, or for as long as Retry-After asks. """
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except HttpError as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.random() * 0.5)
+            try:
+                delay = max(delay, float(e.resp.get('retry-after', 0)))
+            except ValueError:
+                pass  # An HTTP date, just use the backoff.
+            time.sleep(delay)
+            attempt += 1
+
+
+def _execute_with_retry(request, max_retries=5, base=1.0, cap=30.0):
+    """ Execute a Drive API (or batch) request, see _call_with_retry. """
+    return _call_with_retry(request.execute, max_retries, base, cap)
+
+
+def _create_with_retry(request, find, max_retries=5, base=1.0, cap=30.0):
+    """ Execute a Drive create request, see _call_with_retry.
+
+        A create that failed for us may still have worked on Drive's
+        side, and Drive allows duplicate names, so before each retry
+        find() is asked for the file or folder first. It returns its
+        metadata, or None if it isn't there. """
+    attempted = False
+
+    def create():
+        nonlocal attempted
+        if attempted:
+            existing = find()
+            if existing is not None:
+                return existing
+        attempted = True
+        return request.execute()
+    return _call_with_retry(create, max_retries, base, cap)
+
+
+def _first_file(request):
+    """ Execute a files().list request, return its first file or None. """
+    items = request.execute().get('files', [])
+    return items[0] if items else None
 
 
 class GDrive():
 
-    def __init__(self):
-        """ Class constructor """
+    def __init__(self, upload_workers=4):
+        """ Class constructor
+
+            upload_workers is the most files upload_many sends at the
+            same time. """
         # Initialise Google Drive Connection
         # If modifying these scopes, delete your previously saved credentials
         # at ~/.credentials/drive-python-quickstart.json
@@ -28,8 +127,33 @@ class GDrive():
         self.APPLICATION_NAME = 'Drive API Python Quickstart'
 
         self.credentials = self.get_credentials()
-        self.http = self.credentials.authorize(httplib2.Http())
-        self.service = discovery.build('drive', 'v3', http=self.http)
+        # httplib2 connections aren't thread-safe, so each thread gets
+        # its own Drive client (see the service property).
+        self.local = threading.local()
+        # Kept for the life of this object, so its threads (and their
+        # Drive clients) are reused by every upload_many call.
+        self.uploader = ThreadPoolExecutor(max_workers=upload_workers)
+
+        # Folder ids found so far, keyed by (parent id, folder name), so
+        # uploads into the same folders don't look them up every time.
+        self.root_id = None
+        self.path_cache = collections.OrderedDict()
+        self.path_lock = threading.Lock()
+
+    @property
+    def service(self):
+        """ Drive client for the calling thread.
+
+            Each one keeps its authorized connection for the life of this
+            object, so API calls reuse it rather than doing a new TLS
+            handshake. All of them share the same credentials. """
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http())
+            service = discovery.build('drive', 'v3', http=http)
+            self.local.service = service
+        return service
 
     def get_credentials(self):
         """Gets valid user credentials from storage.
@@ -47,87 +171,287 @@ class GDrive():
         credential_path = os.path.join(credential_dir,
                                        'drive-python-quickstart.json')
 
-        store = Storage(credential_path)
-        credentials = store.get()
-        if not credentials or credentials.invalid:
-            flow = client.flow_from_clientsecrets(
+        scopes = self.SCOPES.split()
+        credentials = None
+        if os.path.exists(credential_path):
+            try:
+                credentials = Credentials.from_authorized_user_file(
+                    credential_path, scopes)
+            except ValueError:
+                print('Ignoring unusable credentials in ' + credential_path)
+        if (credentials and not credentials.valid and
+                credentials.refresh_token):
+            try:
+                credentials.refresh(
+                    google_auth_httplib2.Request(httplib2.Http()))
+            except RefreshError:
+                credentials = None
+        if not credentials or not credentials.valid:
+            flow = InstalledAppFlow.from_client_secrets_file(
                 self.CLIENT_SECRET_FILE,
-                self.SCOPES)
-            flow.user_agent = self.APPLICATION_NAME
-            if flags:
-                credentials = tools.run_flow(flow, store, flags)
-            else:  # Needed only for compatibility with Python 2.6
-                credentials = tools.run(flow, store)
+                scopes)
+            flags = _parse_flags()
+            credentials = flow.run_local_server(
+                port=flags.auth_host_port,
+                open_browser=not flags.noauth_local_webserver)
+            with open(credential_path, 'w') as f:
+                f.write(credentials.to_json())
             print('Storing credentials to ' + credential_path)
         return credentials
 
-    def find_file(self, file_name, parent='root', is_folder=False):
-        """ Find a file/folder with parent """
+    def find_file(self, file_name, parent='root', is_folder=False,
+                  defer=False):
+        """ Find a file/folder with parent.
+
+            Only exact name matches count. If parent is None, look in
+            every folder and include each file's parents in the results
+            (only the first page of them, see find_path). If defer is
+            True, return the prepared request instead of executing it. """
         if file_name == "":
             return []
 
         mimeType = "mimeType != 'application/vnd.google-apps.folder'"
         if is_folder:
             mimeType = "mimeType = 'application/vnd.google-apps.folder'"
-        q = ("modifiedTime > '2012-01-01T12:00:00'"
-             " and {}"
-             " and '{}' in parents"
-             " and name contains '{}'"
+        # Callers only need to know the file exists (and where, when
+        # looking in every folder), so ask for as little as possible.
+        in_parent = ""
+        page_size = 100
+        fields = "nextPageToken, files(id, parents)"
+        if parent is not None:
+            in_parent = " and '{}' in parents".format(parent)
+            page_size = 1
+            fields = "files(id)"
+        q = ("{}"
+             "{}"
+             " and name = '{}'"
              " and trashed = false"
-             ).format(mimeType, parent, file_name)
+             ).format(mimeType, in_parent, file_name)
         #print("q=" + q)
 
-        results = self.service.files().list(
+        request = self.service.files().list(
             q=q,
-            pageSize=100,
-            fields="nextPageToken, files(id, name)").execute()
+            pageSize=page_size,
+            fields=fields)
+        if defer:
+            return request
+        results = _execute_with_retry(request)
         items = results.get('files', [])
         return items
 
+    def find_path(self, folders, file_name=""):
+        """ Find a chain of folders, and optionally a file inside the
+            last one, in a single batched round-trip.
+
+            Folders found before are taken from the path cache. Each
+            remaining segment is looked up by name alone (its parent
+            isn't known until the previous segment is found), then the
+            chain is walked locally. If a name has too many matches to
+            fit in one page, it's looked up again inside its parent.
+            If the deepest cached folder has since been deleted or
+            trashed, the cached path is forgotten and looked up afresh.
+
+            Returns the ids of the folders found, in order and stopping
+            at the first missing one, and the ids of the files named
+            file_name in the last folder. """
+        # Walk as far as the cache can take us.
+        parent = self.root_id
+        folder_ids = []
+        if parent is not None:
+            for x in folders:
+                folder_id = self._cached_folder_id(parent, x)
+                if folder_id is None:
+                    break
+                parent = folder_id
+                folder_ids.append(folder_id)
+        first = len(folder_ids)
+        remaining = folders[first:]
+
+        requests = collections.OrderedDict()
+        if self.root_id is None:
+            requests['root'] = self.service.files().get(
+                fileId='root', fields='id')
+        if folder_ids:
+            # Check the cached path is still there (trashing or deleting
+            # a folder does the same to everything in it).
+            requests['cached'] = self.service.files().get(
+                fileId=parent, fields='trashed')
+        for idx, x in enumerate(remaining, first):
+            requests['folder{}'.format(idx)] = self.find_file(
+                x, parent=None, is_folder=True, defer=True)
+        if file_name != "":
+            # With the whole path cached (or no folders at all), the
+            # file's parent is known, even if it's only 'root' so far.
+            file_parent = None
+            if not remaining:
+                file_parent = parent if parent is not None else 'root'
+            requests['file'] = self.find_file(
+                file_name, parent=file_parent, defer=True)
+
+        results = {}
+        failed = {}
+
+        def store(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                results[request_id] = response
+
+        if requests:
+            batch = BatchHttpRequest(callback=store,
+                                     batch_uri=DRIVE_BATCH_URI)
+            for request_id, request in requests.items():
+                batch.add(request, request_id=request_id)
+            _execute_with_retry(batch)
+        # Retry any transient failures inside the batch on their own.
+        stale = False
+        for request_id, exception in failed.items():
+            if (request_id == 'cached' and isinstance(exception, HttpError)
+                    and exception.resp.status == 404):
+                stale = True  # Cached folder has been deleted
+                continue
+            if not (isinstance(exception, HttpError) and
+                    _is_retryable(exception)):
+                raise exception
+            results[request_id] = _execute_with_retry(requests[request_id])
+        if stale or results.get('cached', {}).get('trashed'):
+            # Nothing is cached for this path now, so this only recurses once.
+            self._forget_path(folders)
+            return self.find_path(folders, file_name)
+
+        def in_parent(request_id, name, parent, is_folder=False):
+            response = results[request_id]
+            ids = [item['id'] for item in response.get('files', [])
+                   if parent in item.get('parents', [])]
+            if not ids and 'nextPageToken' in response:
+                # It may be on a later page, ask its parent instead.
+                ids = [item['id'] for item in
+                       self.find_file(name, parent=parent, is_folder=is_folder)]
+            return ids
+
+        if self.root_id is None:
+            self.root_id = parent = results['root']['id']
+        for idx in range(first, len(folders)):
+            ids = in_parent('folder{}'.format(idx), folders[idx], parent,
+                            is_folder=True)
+            if not ids:
+                break  # Folder doesn't exist
+            # Folder exists, remember it and update parent to it.
+            self._cache_folder_id(parent, folders[idx], ids[0])
+            parent = ids[0]
+            folder_ids.append(parent)
+
+        file_ids = []
+        if file_name != "" and len(folder_ids) == len(folders):
+            if remaining:
+                file_ids = in_parent('file', file_name, parent)
+            else:
+                file_ids = [item['id'] for item in
+                            results['file'].get('files', [])]
+        return folder_ids, file_ids
+
+    def _cached_folder_id(self, parent, folder_name):
+        """ Return the cached id of a folder in parent, or None. """
+        key = (parent, folder_name)
+        with self.path_lock:
+            folder_id = self.path_cache.get(key)
+            if folder_id is not None:
+                self.path_cache.move_to_end(key)
+            return folder_id
+
+    def _cache_folder_id(self, parent, folder_name, folder_id):
+        """ Remember the id of a folder in parent. """
+        key = (parent, folder_name)
+        with self.path_lock:
+            self.path_cache[key] = folder_id
+            self.path_cache.move_to_end(key)
+            if len(self.path_cache) > PATH_CACHE_SIZE:
+                # Forget the least recently used folder.
+                self.path_cache.popitem(last=False)
+
+    def _forget_path(self, folders):
+        """ Forget the cached ids of a path's folders, and of any folders
+            cached below them. Returns whether anything was forgotten. """
+        with self.path_lock:
+            stale = set()
+            parent = self.root_id
+            for x in folders:
+                folder_id = self.path_cache.pop((parent, x), None)
+                if folder_id is None:
+                    break
+                stale.add(folder_id)
+                parent = folder_id
+            forgot = bool(stale)
+            while stale:
+                below = [key for key in self.path_cache if key[0] in stale]
+                stale = set(self.path_cache.pop(key) for key in below)
+            return forgot
+
+    def _retry_if_stale(self, folders, call):
+        """ Return call(). If Drive says a folder doesn't exist (404) and
+            the path's folder ids came from the cache, they're probably
+            stale: forget them and call() once more. """
+        try:
+            return call()
+        except HttpError as e:
+            if e.resp.status != 404 or not self._forget_path(folders):
+                raise
+        return call()
+
     def upload(self, local_filepath, remote_path, mimeType='image/jpeg'):
         """ Upload a file """
-        new_file_id = ""
-
         # Split local filename into path and filename
         local_split = local_filepath.split('/')
         # retrieve the filename from the local path/filename
         file_name = local_split[-1]
 
-        # Attempt to find each sequential folder on remote server.
-        full_path_exists = True
-        parent = 'root'
-
         # Split folder path into path segments,
-        remote_path_split = remote_path.split('/')
-        for x in remote_path_split:
-            if x != "" and x != "root":
-                # Find folder.
-                # print("Finding " + parent + "/" + x)
-                items = self.find_file(x, parent=parent, is_folder=True)
-                if len(items):
-                    # Folder exists, update parent to this folder.
-                    parent = items[0]['id']
-                    # print ("Found")
-                else:
-                    full_path_exists = False
-                    # print ("Failed")
-                    break  # Folder doesn't exist
+        # and find them all on remote server in one go.
+        folders = [x for x in remote_path.split('/')
+                   if x != "" and x != "root"]
+        return self._retry_if_stale(folders, lambda: self._upload_to(
+            local_filepath, folders, file_name, mimeType))
+
+    def _upload_to(self, local_filepath, folders, file_name, mimeType):
+        """ Upload a file into the folder path given by folders. """
+        new_file_id = ""
+        folder_ids, file_ids = self.find_path(folders, file_name)
 
-        if full_path_exists:
-            items = self.find_file(file_name, parent=parent, is_folder=False)
-            if len(items) == 0:
+        if len(folder_ids) == len(folders):
+            parent = folder_ids[-1] if folder_ids else 'root'
+            if len(file_ids) == 0:
                 # File doesn't exist
                 file_metadata = {
                     'name': file_name,
                     'parents': ['{}'.format(parent)]
                 }
-                media = MediaFileUpload(
-                    local_filepath,
-                    mimetype=mimeType)
-                file = self.service.files().create(
-                    body=file_metadata,
-                    media_body=media,
-                    fields='id').execute()
+                if os.path.getsize(local_filepath) < UPLOAD_CHUNK_SIZE:
+                    # Small enough to send in one request.
+                    media = MediaFileUpload(
+                        local_filepath,
+                        mimetype=mimeType)
+                    file = _create_with_retry(
+                        self.service.files().create(
+                            body=file_metadata,
+                            media_body=media,
+                            fields='id'),
+                        lambda: _first_file(self.find_file(
+                            file_name, parent=parent, defer=True)))
+                else:
+                    # Send large files in resumable chunks, so an error
+                    # only means resending the current chunk.
+                    media = MediaFileUpload(
+                        local_filepath,
+                        mimetype=mimeType,
+                        chunksize=UPLOAD_CHUNK_SIZE,
+                        resumable=True)
+                    request = self.service.files().create(
+                        body=file_metadata,
+                        media_body=media,
+                        fields='id')
+                    file = None
+                    while file is None:
+                        status, file = _call_with_retry(request.next_chunk)
                 new_file_id = file.get('id')
                 # print('File ID: {}'.format(new_file_id))
             else:
@@ -137,26 +461,35 @@ class GDrive():
         # Return the uploaded files ID
         return new_file_id
 
+    def upload_many(self, jobs):
+        """ Upload several files at the same time (see upload_workers).
+
+            jobs is a list of (local_filepath, remote_path, mimeType)
+            tuples, mimeType being optional. Returns the new file IDs
+            in the same order as jobs. """
+        futures = [self.uploader.submit(self.upload, *job) for job in jobs]
+        return [future.result() for future in futures]
+
     def create_folder(self, folder_name):
         """ Create a new folder """
+        # Split folder path into path segments,
+        # and find the ones that already exist.
+        folders = [x for x in folder_name.split('/')
+                   if x != "" and x != "root"]
+        return self._retry_if_stale(
+            folders, lambda: self._create_path(folders))
+
+    def _create_path(self, folders):
+        """ Create whichever folders of a path don't exist yet. """
         new_folder_id = ""
-        parent = 'root'
-
-        # Split folder path into path segments
-        remote_path_split = folder_name.split('/')
-        for x in remote_path_split:
-            if x != "" and x != "root":
-                # Find folder.
-                # print("Finding " + parent + "/" + x)
-                items = self.find_file(x, parent=parent, is_folder=True)
-                if len(items):
-                    #print("Folder Exists")
-                    # Folder exists, update parent to this folder.
-                    parent = items[0]['id']
-                else:
-                    # Folder doesn't exists. Create it now.
-                    parent = self.create_single_folder(x, parent)
-                    new_folder_id = parent
+        folder_ids = self.find_path(folders)[0]
+        parent = folder_ids[-1] if folder_ids else self.root_id
+
+        # Create the missing folders, and remember them for next time.
+        for x in folders[len(folder_ids):]:
+            folder_id = self.create_single_folder(x, parent)
+            self._cache_folder_id(parent, x, folder_id)
+            parent = new_folder_id = folder_id
         return new_folder_id
 
     def create_single_folder(self, folder_name, parent='root'):
@@ -167,19 +500,18 @@ class GDrive():
         #print("Creating " + folder_name + ": parent = " + parent)
 
         new_folder_id = ""
-        q = ("modifiedTime > '2012-01-01T12:00:00'"
-             " and mimeType = 'application/vnd.google-apps.folder'"
+        q = ("mimeType = 'application/vnd.google-apps.folder'"
              " and '{}' in parents"
              " and name = '{}'"
              " and trashed = false"
              ).format(parent, folder_name)
         # print("q=" + q)
 
-        results = self.service.files().list(
+        request = self.service.files().list(
             q=q,
-            pageSize=100,
-            fields="nextPageToken, files(id, name)").execute()
-        items = results.get('files', [])
+            pageSize=1,
+            fields="files(id)")
+        items = _execute_with_retry(request).get('files', [])
 
         if not items:
             # print('Folder not found')
@@ -189,9 +521,11 @@ class GDrive():
                 'parents': ['{}'.format(parent)]
             }
             #print(file_metadata)
-            file = self.service.files().create(
-                body=file_metadata,
-                fields='id').execute()
+            file = _create_with_retry(
+                self.service.files().create(
+                    body=file_metadata,
+                    fields='id'),
+                lambda: _first_file(request))
             new_folder_id = file.get('id')
             # print('New folder ID: {}'.format(new_folder_id))
         else:
@@ -201,7 +535,7 @@ class GDrive():
 
     def list_all_files(self):
         """ Simple method to list all files and folders in specific folder """
-        results = self.service.files().list(
+        results = _execute_with_retry(self.service.files().list(
             q=("modifiedTime > '2012-06-04T12:00:00' and "
                "name = 'Wills' and "
                "'root' in parents and "
@@ -209,7 +543,7 @@ class GDrive():
                ),
                #"(mimeType contains 'image/' or mimeType contains 'video/')"),
             pageSize=10,
-            fields="nextPageToken, files(id, name, trashed)").execute()
+            fields="nextPageToken, files(id, name, trashed)"))
         items = results.get('files', [])
         if not items:
             print('No files found.')
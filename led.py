@@ -34,11 +34,54 @@ CONFIG_FILES = [
     os.path.join(CONFIG_DIR, 'status-led.ini')
 ]
 
+# Full LED duty cycle, also used as the PWM frequency in Hz.
+MAX_PWM = 100
+
 
 class LED:
 
     """Starts a background thread to show patterns with the LED."""
 
+    # PWM duty cycle for each step of the animated states, and the sleep
+    # between steps. Built once, rather than every time the state changes.
+    _PATTERNS = {
+        'blink': (
+            (0, MAX_PWM),
+            0.5),
+        'blink-3': (
+            (0, MAX_PWM) * 3 + (0, 0),
+            0.25),
+        'beacon': (
+            tuple(itertools.chain(
+                [30] * 100, [MAX_PWM] * 8,
+                range(MAX_PWM, 30, -5))),
+            0.05),
+        'beacon-dark': (
+            tuple(itertools.chain(
+                [0] * 10,  # Delay between pulses: 10 values of [0] with 0.05 seconds sleep between
+                range(0, 30, 3),
+                range(30, 0, -3))),
+            0.05),
+        'decay': (
+            tuple(range(MAX_PWM, 0, -2)),
+            0.05),
+        'pulse-slow': (
+            tuple(itertools.chain(
+                range(0, MAX_PWM, 2),
+                range(MAX_PWM, 0, -2))),
+            0.1),
+        'pulse-slow-dark': (
+            tuple(itertools.chain(
+                range(10, 80, 2),
+                range(80, 10, -2))),
+            0.1),
+        'pulse-quick': (
+            tuple(itertools.chain(
+                range(0, MAX_PWM, 5),
+                range(MAX_PWM, 0, -5))),
+            0.05),
+    }
+
     def __init__(self, channel):
         self.animator = threading.Thread(target=self._animate)
         self.channel = channel
@@ -47,8 +90,14 @@ class LED:
         self.state = None
         self.last_known_state = None
         self.sleep = 0
+        # Set by set_state() and stop() to wake up the animator.
+        self._state_changed = threading.Event()
+        self._new_state = None
+        # Last duty cycle and colour sent by the animation frames.
+        self._last_duty = None
+        self._last_rgb = None
 
-        self.max_pwm = 100
+        self.max_pwm = MAX_PWM
         GPIO.setup(channel, GPIO.OUT)  # GPIO pin 25 by default
         self.pwm = GPIO.PWM(channel, self.max_pwm)
 
@@ -68,6 +117,7 @@ class LED:
         self.base_red = 255
         self.base_green = 0
         self.base_blue = 0
+        self._build_rgb_lut()
 
     def start(self):
         self.pwm.start(0)  # off by default
@@ -76,17 +126,37 @@ class LED:
 
     def stop(self):
         self.running = False
+        self._state_changed.set()
         self.animator.join()
         self.pwm.stop()
         GPIO.output(self.channel, GPIO.LOW)
 
     def set_state(self, state):
-        self.state = state
         self.last_known_state = state
         # Everytime state is changed, reset colour
         self.base_red = 255
         self.base_green = 0
         self.base_blue = 0
+        self._build_rgb_lut()
+        # Make sure the first frame of the new state is always sent.
+        self._last_duty = None
+        self._last_rgb = None
+        self._new_state = state
+        self._state_changed.set()
+
+    def _build_rgb_lut(self):
+        """Scale the base colour for every duty cycle, with integer maths."""
+        # Vary LED brightness but keep colour
+        self._rgb_lut = tuple(
+            (brightness * self.base_red // self.max_brightness,
+             brightness * self.base_green // self.max_brightness,
+             brightness * self.base_blue // self.max_brightness)
+            for brightness in range(self.max_pwm + 1))
+
+    def _frames(self, duties):
+        """Return (duty, red, green, blue) for each step of an animation."""
+        lut = self._rgb_lut
+        return tuple((duty,) + lut[duty] for duty in duties)
 
     def _animate(self):
         # TODO(ensonic): refactor or add justification
@@ -94,6 +164,9 @@ class LED:
 
         # base colour used to flash/pulse/light the led.
         while self.running:
+            if self._state_changed.is_set():
+                self._state_changed.clear()
+                self.state = self._new_state
             if self.state:
                 if self.state == 'on-green':
                     # Used when RECORDING VOICE
@@ -104,6 +177,7 @@ class LED:
                     self.base_red = 0
                     self.base_green = 190
                     self.base_blue = 0
+                    self._build_rgb_lut()
                     # Turn ON the led
                     self.bstick.set_color(
                         channel=self.led_channel,
@@ -133,66 +207,33 @@ class LED:
                         red=0,
                         green=0,
                         blue=0)
-                elif self.state == 'blink':
-                    self.iterator = itertools.cycle([0, self.max_pwm])
-                    self.sleep = 0.5
-                elif self.state == 'blink-3':
-                    self.iterator = itertools.cycle(
-                        [0, self.max_pwm] * 3 + [0, 0])
-                    self.sleep = 0.25
-                elif self.state == 'beacon':
-                    self.iterator = itertools.cycle(
-                        itertools.chain(
-                            [30] * 100, [self.max_pwm] * 8,
-                            range(self.max_pwm, 30, -5)))
-                    self.sleep = 0.05
-                elif self.state == 'beacon-dark':
-                    self.iterator = itertools.cycle(
-                        itertools.chain(
-                            [0] * 10,  # Delay between pulses: 10 values of [0] with 0.05 seconds sleep between
-                            range(0, 30, 3),
-                            range(30, 0, -3)))
-                    self.sleep = 0.05
-                elif self.state == 'decay':
-                    self.iterator = itertools.cycle(range(self.max_pwm, 0, -2))
-                    self.sleep = 0.05
-                elif self.state == 'pulse-slow':
-                    self.iterator = itertools.cycle(
-                        itertools.chain(
-                            range(0, self.max_pwm, 2),
-                            range(self.max_pwm, 0, -2)))
-                    self.sleep = 0.1
-                elif self.state == 'pulse-slow-dark':
-                    self.iterator = itertools.cycle(
-                        itertools.chain(
-                            range(10, 80, 2),
-                            range(80, 10, -2)))
-                    self.sleep = 0.1
-                elif self.state == 'pulse-quick':
-                    self.iterator = itertools.cycle(
-                        itertools.chain(
-                            range(0, self.max_pwm, 5),
-                            range(self.max_pwm, 0, -5)))
-                    self.sleep = 0.05
+                elif self.state in LED._PATTERNS:
+                    duties, self.sleep = LED._PATTERNS[self.state]
+                    self.iterator = itertools.cycle(self._frames(duties))
                 else:
                     logger.warning("unsupported state: %s", self.state)
                 self.state = None
             if self.iterator:
-                new_value = next(self.iterator)
-                self.pwm.ChangeDutyCycle(new_value)
-
-                # Vary LED brightness but keep colour
-                brightness = (min(self.max_pwm, new_value) / self.max_brightness)
-
-                self.bstick.set_color(
-                    channel=self.led_channel,
-                    index=self.led_index,
-                    red=self.base_red * brightness,
-                    green=self.base_green * brightness,
-                    blue=self.base_blue * brightness)
-                time.sleep(self.sleep)
+                new_value, red, green, blue = next(self.iterator)
+                # Only send changes, each BlinkStick update is a slow
+                # USB transfer and many frames repeat the last one.
+                if new_value != self._last_duty:
+                    self.pwm.ChangeDutyCycle(new_value)
+                    self._last_duty = new_value
+                rgb = (red, green, blue)
+                if rgb != self._last_rgb:
+                    self.bstick.set_color(
+                        channel=self.led_channel,
+                        index=self.led_index,
+                        red=red,
+                        green=green,
+                        blue=blue)
+                    self._last_rgb = rgb
+                # Sleep until the next frame, unless the state changes.
+                self._state_changed.wait(timeout=self.sleep)
             else:
-                time.sleep(0.25)
+                # Nothing to animate, wait for the state to change.
+                self._state_changed.wait()
 
 
 def main():
@@ -14,7 +14,6 @@
 
 """Wrapper around a TTS system."""
 
-import functools
 import logging
 import os
 import subprocess
@@ -63,13 +62,31 @@ def create_eq_filter():
 def create_say(player):
     """Return a function say(words) for the given player, using the default EQ
     filter.
+
+    The returned function also has a prepare(words) method, which synthesizes
+    a fixed phrase up front so that later calls to say it just play the cached
+    audio instead of running the TTS engine again.
     """
     lang = i18n.get_language_code()
-    return functools.partial(say, player, eq_filter=create_eq_filter(), lang=lang)
+    eq_filter = create_eq_filter()
+    cache = {}
 
+    def cached_say(words, wav_file=None):
+        eq_bytes = cache.get(words) if wav_file is None else None
+        if eq_bytes is None:
+            eq_bytes = synthesize(words, wav_file, eq_filter=eq_filter, lang=lang)
+        player.play_bytes(eq_bytes, sample_rate=SAMPLE_RATE)
 
-def say(player, words, wav_file=None, eq_filter=None, lang='en-US'):
-    """Say the given words with TTS."""
+    def prepare(words):
+        if words not in cache:
+            cache[words] = synthesize(words, eq_filter=eq_filter, lang=lang)
+
+    cached_say.prepare = prepare
+    return cached_say
+
+
+def synthesize(words, wav_file=None, eq_filter=None, lang='en-US'):
+    """Return the given words as equalized 16-bit audio at SAMPLE_RATE."""
     if wav_file is None:
         try:
             (fd, raw_wav) = tempfile.mkstemp(suffix='.wav', dir=TMP_DIR)
@@ -96,8 +113,12 @@ def say(player, words, wav_file=None, eq_filter=None, lang='en-US'):
     # Clip and serialize
     int16_info = np.iinfo(np.int16)
     eq_audio = np.clip(eq_audio, int16_info.min, int16_info.max)
-    eq_bytes = eq_audio.astype(np.int16).tostring()
+    return eq_audio.astype(np.int16).tostring()
+
 
+def say(player, words, wav_file=None, eq_filter=None, lang='en-US'):
+    """Say the given words with TTS."""
+    eq_bytes = synthesize(words, wav_file, eq_filter=eq_filter, lang=lang)
     player.play_bytes(eq_bytes, sample_rate=SAMPLE_RATE)
 
 